@@ -5,20 +5,41 @@ Purpose: Generate, execute, and manage R scripts within a user-specified directo
 Requirements: Python 3.8+, MCP SDK, R runtime (Rscript in PATH)
 """
 
+import asyncio
+import atexit
+import hashlib
 import json
 import logging
 import os
+import re
 import shutil
+import signal
+import stat
 import subprocess
 import sys
 import time
 import base64
+import codecs
 import csv
-import traceback
+import fnmatch
+import functools
+import heapq
+import itertools
+import operator
+import tempfile
+import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+try:
+    import orjson
+except ImportError:
+    # Optional faster JSON backend; the standard library is used without it
+    orjson = None
+
 from mcp.server import Server
 from mcp.types import Tool, TextContent
 from mcp.server.stdio import stdio_server
@@ -31,6 +52,15 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+def _dumps(obj: Any) -> str:
+    """Serialize a tool result; compact unless debug logging is on"""
+    pretty = logger.isEnabledFor(logging.DEBUG)
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else None).decode('utf-8')
+    if pretty:
+        return json.dumps(obj, indent=2)
+    return json.dumps(obj, separators=(',', ':'))
+
 # R script scaffold template - now minimal, getting straight to business
 R_SCAFFOLD = """# ---- Packages ----
 library(ggplot2)
@@ -41,6 +71,58 @@ library(ggplot2)
 
 """
 
+# R code run by inspect_r_objects. Results are printed as one line of JSON
+# when jsonlite is installed, and with print() otherwise.
+R_INSPECT_EMIT = """
+if(requireNamespace("jsonlite", quietly = TRUE)) {
+    cat(jsonlite::toJSON(results, auto_unbox = TRUE, null = "null", force = TRUE), "\\n")
+} else if(length(results) > 0) {
+    print(results)
+} else {
+    print("No objects in workspace")
+}
+"""
+
+# {names} and {level} are filled in per call
+R_INSPECT_OBJECTS_TEMPLATE = """
+load('.RData')
+objects_to_inspect <- c({names})
+results <- vector("list", length(objects_to_inspect))
+names(results) <- objects_to_inspect
+for(i in seq_along(objects_to_inspect)) {{
+    obj_name <- objects_to_inspect[[i]]
+    if(exists(obj_name, inherits = FALSE)) {{
+        obj <- get(obj_name, inherits = FALSE)
+        results[[i]] <- list(
+            class = class(obj),
+            typeof = typeof(obj),
+            length = length(obj),
+            dim = dim(obj),
+            names = names(obj),
+            str = capture.output(str(obj, max.level={level}))
+        )
+    }} else {{
+        results[[i]] <- "Object not found"
+    }}
+}}
+""" + R_INSPECT_EMIT.replace("{", "{{").replace("}", "}}")
+
+R_INSPECT_ALL_TEMPLATE = """
+load('.RData')
+obj_list <- ls()
+results <- vector("list", length(obj_list))
+names(results) <- obj_list
+for(i in seq_along(obj_list)) {
+    obj <- get(obj_list[[i]])
+    results[[i]] <- list(
+        class = class(obj),
+        typeof = typeof(obj),
+        length = length(obj),
+        dim = dim(obj)
+    )
+}
+""" + R_INSPECT_EMIT
+
 # ggplot Style Guide for reference
 GGPLOT_STYLE_GUIDE = """
 # ggplot Style Guide - One-Time Code Optimization
@@ -99,32 +181,801 @@ ggsave("plot.png", p, width=5, height=4, dpi=800)
 - Humanize variable names in labels
 """
 
+_GGSAVE_DPI_RE = re.compile(r'\bdpi\s*=')
+_GGSAVE_WIDTH_RE = re.compile(r'\bwidth\s*=')
+
+def _find_call_close(code: str, start: int) -> int:
+    """Offset of the ")" closing a call whose arguments begin at start, or len(code)"""
+    depth = 0
+    i = start
+    n = len(code)
+    while i < n:
+        ch = code[i]
+        if ch in '"\'`':
+            # Skip string literals and backquoted names, honouring escapes
+            i += 1
+            while i < n and code[i] != ch:
+                i += 2 if code[i] == '\\' else 1
+        elif ch == '#':
+            # Skip comments to the end of the line
+            newline = code.find('\n', i)
+            i = n if newline < 0 else newline
+        elif ch in '([{':
+            depth += 1
+        elif ch in ')]}':
+            if depth == 0:
+                return i
+            depth -= 1
+        i += 1
+    return n
+
+def _ggsave_defaults(code: str, end: int, applied: Set[str]) -> str:
+    """Build the arguments to inject into a ggsave( call ending at offset end"""
+    # Existing arguments are checked up to the call's matching ")", so nested
+    # calls such as file.path(...) do not cut the span short
+    call_args = code[end:_find_call_close(code, end)]
+    injected = ''
+    if not _GGSAVE_WIDTH_RE.search(call_args):
+        applied.add("dimensions")
+        injected += 'width=5, height=4, '
+    if not _GGSAVE_DPI_RE.search(call_args):
+        applied.add("dpi")
+        injected += 'dpi=800, '
+    return 'ggsave(' + injected
+
+# Style guide rewrites as (name, pattern, replacement). A string replacement
+# is substituted as-is and recorded under its name; a callable is given the
+# code, the match end and the set of applied change names.
+_GGPLOT_RULES = (
+    ("assign", r'<-', '='),
+    ("theme", r'theme_gr[ae]y\(\)', 'theme_minimal(base_size=14)'),
+    ("ggsave", r'ggsave\(', _ggsave_defaults),
+)
+# All rules compiled into one alternation, so the code is scanned once
+_GGPLOT_SUB_RE = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern, _ in _GGPLOT_RULES))
+_GGPLOT_REPLACEMENTS = {name: replacement for name, _, replacement in _GGPLOT_RULES}
+_GGPLOT_CHANGE_MESSAGES = (
+    ("assign", "Replaced <- with = for assignments"),
+    ("theme", "Replaced default theme with theme_minimal(base_size=14)"),
+    ("dpi", "Added dpi=800 to ggsave for high quality output"),
+    ("dimensions", "Added optimal dimensions (5x4 inches) to ggsave"),
+)
+
+# Constructs the style checks look for, by marker name
+_STYLE_MARKERS = (
+    ("theme", r'\btheme_\w+\s*\('),
+    ("scale", r'\bscale_\w+\s*\('),
+    ("ggplot", r'\bggplot\s*\('),
+    ("labels", r'\b(?:labs|xlab|ylab)\s*\('),
+    ("ggsave", r'\bggsave\s*\('),
+)
+# All markers compiled into one alternation, so the code is scanned once
+_STYLE_MARKER_RE = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in _STYLE_MARKERS))
+
+# Style checks as (trigger markers, satisfying markers, issue, suggestion). A
+# check fires when all trigger markers occur in the code and none of the
+# satisfying ones do; checks without an issue only add a suggestion.
+_STYLE_CHECK_RULES = (
+    ((), ("theme",), "No theme specified",
+     "Add theme_minimal(base_size=14) for clean, readable plots"),
+    (("ggplot",), ("scale",), "No explicit color scale",
+     "Add scale_color_brewer(palette='Set2') for categorical or scale_color_viridis() for continuous"),
+    ((), ("labels",), "No axis labels specified",
+     "Add descriptive labels with labs(x='...', y='...', title='...')"),
+    ((), ("ggsave",), None,
+     "Remember to save with ggsave('filename.png', width=5, height=4, dpi=800)"),
+)
+
+# Seconds to wait before writing state.json, so bursts of updates share one write
+STATE_FLUSH_DELAY = 0.5
+
+# Read buffer for preview_table, large enough to pull in a preview in one read
+CSV_PREVIEW_BUFFER_SIZE = 1 << 20
+
+# Filesystem types where every stat() is a network round trip
+REMOTE_FS_TYPES = frozenset({
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p", "afs", "ceph", "glusterfs",
+    # macOS names, as printed by mount
+    "afpfs", "webdav", "macfuse", "osxfuse",
+})
+# A line of macOS mount output: "device on /mount/point (type, options...)"
+_MOUNT_LINE_RE = re.compile(r'^.+? on (.+) \(([^,)]+)')
+
+# Threads used to overlap stat() calls when listing a remote workdir
+REMOTE_STAT_WORKERS = 16
+
+# Seconds a workdir listing is reused by list_exports and list_r_files
+WORKDIR_SNAPSHOT_TTL = 0.5
+
+# Seconds a persistent R session may sit idle before it is shut down
+R_BACKEND_IDLE_TIMEOUT = 60
+
+# Seconds a new persistent R session has to load its driver and preloaded packages
+R_BACKEND_START_TIMEOUT = 30
+
+# Maximum number of persistent R sessions alive at once
+R_SESSION_POOL_SIZE = 4
+
+# Longest line read from a persistent R session's stdout
+R_BACKEND_LINE_LIMIT = 1 << 20
+
+# Most stdout/stderr kept per R run, and the chunk size it is read in
+R_OUTPUT_LIMIT = 1 << 20
+R_OUTPUT_CHUNK_SIZE = 1 << 16
+
+# Number of pure R expression/script results kept in memory
+R_RESULT_CACHE_SIZE = 128
+
+# Window for coalescing run_r_expression calls, and the most expressions per batch
+R_BATCH_WINDOW = 0.005
+R_BATCH_MAX_SIZE = 8
+
+# Expressions that change session-wide settings or graphics devices are never batched
+R_BATCH_UNSAFE_RE = re.compile(r'\b(?:options|setwd|sink|par|dev\.\w+|png|jpeg|bmp|tiff|pdf|svg|postscript|x11|quartz|windows|q|quit)\s*\(')
+
+# Packages loaded when a persistent R session starts, overridable through
+# the preload_packages field of state.json
+R_PRELOAD_PACKAGES = ["ggplot2"]
+
+# Environment variables that change R's behaviour, and so split the session pool
+R_SESSION_ENV_KEYS = ("R_HOME", "R_LIBS", "R_LIBS_SITE", "R_LIBS_USER", "LANG", "LC_ALL")
+
+# Marker printed by the persistent R session once a job has finished
+R_BACKEND_SENTINEL = "__TIDY_DONE__"
+
+# Driver loaded once into every persistent R session. Each job is sourced into a
+# fresh environment with output and messages sunk into per-job files. Afterwards
+# the driver closes the graphics devices and connections the job opened, restores
+# options(), detaches packages it attached and removes globals it created, so the
+# next job starts close to a fresh Rscript. Loaded namespaces, environment
+# variables and changes to globals that already existed are still shared.
+# .tidy_run_batch runs several jobs in one round-trip, reporting each job's status
+# under its own token as soon as it finishes.
+R_BACKEND_DRIVER = """
+local({
+    driver <- attach(NULL, name = "tidybrain:driver")
+    driver$.tidy_job <- function(job_file, out_file, err_file, wd, save_rdata) {
+        old_options <- options()
+        old_search <- search()
+        old_globals <- ls(globalenv(), all.names = TRUE)
+        old_connections <- getAllConnections()
+        out_con <- file(out_file, open = "wt")
+        err_con <- file(err_file, open = "wt")
+        sink(out_con)
+        sink(err_con, type = "message")
+        status <- 0L
+        env <- new.env(parent = globalenv())
+        tryCatch({
+            setwd(wd)
+            withCallingHandlers(
+                source(job_file, local = env, print.eval = TRUE, encoding = "UTF-8"),
+                warning = function(w) {
+                    message("Warning message:\\n", conditionMessage(w))
+                    invokeRestart("muffleWarning")
+                }
+            )
+            if (save_rdata) {
+                save(list = ls(env, all.names = TRUE), envir = env, file = ".RData")
+            }
+        }, error = function(e) {
+            status <<- 1L
+            call <- conditionCall(e)
+            if (is.null(call)) {
+                message("Error: ", conditionMessage(e))
+            } else {
+                message("Error in ", deparse(call)[1], " : ", conditionMessage(e))
+            }
+        })
+        sink(type = "message")
+        while (sink.number() > 0) sink()
+        close(err_con)
+        close(out_con)
+        graphics.off()
+        new_options <- setdiff(names(options()), names(old_options))
+        options(c(old_options, setNames(vector("list", length(new_options)), new_options)))
+        for (name in setdiff(search(), old_search)) {
+            try(detach(name, character.only = TRUE), silent = TRUE)
+        }
+        rm(list = setdiff(ls(globalenv(), all.names = TRUE), old_globals), envir = globalenv())
+        for (con in setdiff(getAllConnections(), old_connections)) {
+            try(close(getConnection(con)), silent = TRUE)
+        }
+        status
+    }
+    driver$.tidy_run <- function(token, job_file, out_file, err_file, wd, save_rdata) {
+        status <- .tidy_job(job_file, out_file, err_file, wd, save_rdata)
+        cat("__TIDY_DONE__:", token, ":", status, "\\n", sep = "")
+        flush(stdout())
+        invisible(NULL)
+    }
+    driver$.tidy_run_batch <- function(token, job_files, out_files, err_files, wd) {
+        for (i in seq_along(job_files)) {
+            status <- .tidy_job(job_files[i], out_files[i], err_files[i], wd, FALSE)
+            cat("__TIDY_DONE__:", token, "-", i - 1L, ":", status, "\\n", sep = "")
+            flush(stdout())
+        }
+        invisible(NULL)
+    }
+})
+"""
+
+def _decode_output(data: bytes, truncated: bool) -> str:
+    """Decode captured R output, dropping a character cut off by the limit"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    return decoder.decode(data, final=not truncated)
+
+async def _read_stream_capped(stream: asyncio.StreamReader, limit: int) -> Tuple[bytes, bool]:
+    """Read a stream to EOF keeping at most limit bytes; returns (data, truncated)"""
+    buf = bytearray()
+    truncated = False
+    while True:
+        chunk = await stream.read(R_OUTPUT_CHUNK_SIZE)
+        if not chunk:
+            return bytes(buf), truncated
+        room = limit - len(buf)
+        if len(chunk) > room:
+            # Keep draining so R never blocks on a full pipe
+            truncated = True
+            chunk = chunk[:room]
+        buf += chunk
+
+def _r_string_literal(value: str) -> str:
+    """Quote a string as an R double-quoted literal"""
+    # JSON string escapes are all valid in R; ensure_ascii=False avoids \u
+    # surrogate pairs, which R rejects, for characters outside the BMP
+    return json.dumps(value, ensure_ascii=False)
+
+class RBackend:
+    """Persistent R process that evaluates jobs sent over stdin"""
+
+    def __init__(self, proc: asyncio.subprocess.Process, workdir: Path):
+        self.proc = proc
+        self.workdir = workdir
+        self.job_dir = Path(tempfile.mkdtemp(prefix="tidybrain-"))
+        self.last_used = time.time()
+
+    @classmethod
+    async def start(cls, r_exe: str, workdir: Path, env: Dict[str, str], preload: Optional[List[str]] = None) -> "RBackend":
+        """Launch R, load the job driver and preloaded package namespaces"""
+        proc = await asyncio.create_subprocess_exec(
+            r_exe, "--slave", "--no-save", "--no-restore",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            cwd=str(workdir),
+            env=env,
+            start_new_session=True,
+            limit=R_BACKEND_LINE_LIMIT
+        )
+        backend = cls(proc, workdir)
+        await backend._send(R_BACKEND_DRIVER)
+        if preload:
+            # Load namespaces without attaching them, so scripts still need library()
+            # as under Rscript but find it warm; local() keeps pkg out of globalenv
+            await backend._send(
+                f"local(for (pkg in c({', '.join(_r_string_literal(pkg) for pkg in preload)})) "
+                "suppressPackageStartupMessages(requireNamespace(pkg, quietly = TRUE)))"
+            )
+        # Only hand the session out once R confirms the driver is in place
+        token = uuid.uuid4().hex
+        await backend._send(
+            f'cat("{R_BACKEND_SENTINEL}:{token}:", as.integer(!exists(".tidy_run_batch")), "\\n", sep = ""); '
+            "flush(stdout())"
+        )
+        try:
+            status, stray_output, _ = await asyncio.wait_for(
+                backend._wait_done(f"{R_BACKEND_SENTINEL}:{token}:"), R_BACKEND_START_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            backend.close(force=True)
+            raise ConnectionError(f"R session did not become ready within {R_BACKEND_START_TIMEOUT} seconds")
+        if status != "0" or not backend.is_alive():
+            backend.close(force=True)
+            detail = stray_output.strip() or f"status {status}"
+            raise ConnectionError(f"R session failed to start: {detail}")
+        return backend
+
+    async def _send(self, code: str) -> None:
+        self.proc.stdin.write((code if code.endswith('\n') else code + '\n').encode('utf-8'))
+        await self.proc.stdin.drain()
+
+    def is_alive(self) -> bool:
+        return self.proc.returncode is None
+
+    async def run(self, timeout: int, code: Optional[str] = None, file: Optional[Path] = None, save_rdata: bool = False) -> Dict[str, Any]:
+        """Run R code or a script file and wait for its sentinel"""
+        token = uuid.uuid4().hex
+        job_file = self.job_dir / f"{token}.R"
+        out_file = self.job_dir / f"{token}.out"
+        err_file = self.job_dir / f"{token}.err"
+        if file is None:
+            job_file.write_text(code or "", encoding="utf-8")
+        else:
+            job_file = file
+
+        start_time = time.time()
+        await self._send(
+            f".tidy_run({_r_string_literal(token)}, {_r_string_literal(str(job_file))}, "
+            f"{_r_string_literal(str(out_file))}, {_r_string_literal(str(err_file))}, "
+            f"{_r_string_literal(str(self.workdir))}, {'TRUE' if save_rdata else 'FALSE'})"
+        )
+        status, stray_output, stray_truncated = await asyncio.wait_for(
+            self._wait_done(f"{R_BACKEND_SENTINEL}:{token}:"), timeout
+        )
+
+        elapsed = time.time() - start_time
+        result = self._collect(out_file, err_file, int(status or 1), elapsed)
+        result["stdout"] += stray_output
+        result["truncated_stdout"] = result["truncated_stdout"] or stray_truncated
+        if file is None:
+            job_file.unlink(missing_ok=True)
+        return result
+
+    async def run_batch(self, timeout: int, codes: List[str],
+                        on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None) -> List[Optional[Dict[str, Any]]]:
+        """Run several pieces of R code in a single round-trip; jobs cut off by the timeout come back as None"""
+        token = uuid.uuid4().hex
+        jobs = []
+        for i, code in enumerate(codes):
+            job_file = self.job_dir / f"{token}-{i}.R"
+            job_file.write_text(code, encoding="utf-8")
+            jobs.append((job_file, self.job_dir / f"{token}-{i}.out", self.job_dir / f"{token}-{i}.err"))
+
+        start_time = time.time()
+        deadline = start_time + timeout
+        await self._send(
+            f".tidy_run_batch({_r_string_literal(token)}, "
+            + ", ".join(f"c({', '.join(_r_string_literal(str(job[col])) for job in jobs)})" for col in range(3))
+            + f", {_r_string_literal(str(self.workdir))})"
+        )
+        results: List[Optional[Dict[str, Any]]] = []
+        exit_status = None
+        for i, (job_file, out_file, err_file) in enumerate(jobs):
+            stray_output, stray_truncated = "", False
+            if exit_status is None:
+                try:
+                    status, stray_output, stray_truncated = await asyncio.wait_for(
+                        self._wait_done(f"{R_BACKEND_SENTINEL}:{token}-{i}:"), max(deadline - time.time(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    # Jobs that already finished keep their results; R is still busy with this one
+                    results.extend([None] * (len(jobs) - i))
+                    break
+                if not self.is_alive():
+                    # R exited mid-batch, so status is its exit code rather than this job's
+                    exit_status = status
+            elapsed = time.time() - start_time
+            start_time = time.time()
+            if exit_status is None:
+                result = self._collect(out_file, err_file, int(status), elapsed)
+            else:
+                started = out_file.exists()
+                result = self._collect(out_file, err_file, int(exit_status or 1), elapsed)
+                result["ok"] = False
+                result["error"] = {
+                    "code": "R_EXITED",
+                    "message": (
+                        f"R exited with status {exit_status or 'unknown'} "
+                        + ("before reporting this expression's status" if started else "before this expression ran")
+                    ),
+                    "hints": ["Run the expression with allow_batching=false"]
+                }
+            result["stdout"] += stray_output
+            result["truncated_stdout"] = result["truncated_stdout"] or stray_truncated
+            results.append(result)
+            if on_result:
+                on_result(i, result)
+        for job_file, _, _ in jobs:
+            job_file.unlink(missing_ok=True)
+        return results
+
+    def _collect(self, out_file: Path, err_file: Path, returncode: int, elapsed: float) -> Dict[str, Any]:
+        """Build a job result from its sunk output files, removing them"""
+        self.last_used = time.time()
+        captured = {}
+        for stream, path in (("stdout", out_file), ("stderr", err_file)):
+            try:
+                data, size = _read_head(path, R_OUTPUT_LIMIT)
+            except FileNotFoundError:
+                data, size = b"", 0
+            captured[stream] = _decode_output(data, size > len(data))
+            captured[f"truncated_{stream}"] = size > len(data)
+            path.unlink(missing_ok=True)
+        return {
+            "ok": returncode == 0,
+            **captured,
+            "returncode": returncode,
+            "elapsed_seconds": elapsed
+        }
+
+    async def _wait_done(self, done_prefix: str) -> Tuple[str, str, bool]:
+        """Read R stdout up to the job sentinel; returns (status, stray output, truncated)"""
+        prefix = done_prefix.encode("utf-8")
+        stray_output = bytearray()
+        truncated = False
+        while True:
+            try:
+                line = await self.proc.stdout.readline()
+            except ValueError:
+                # The reader drops lines longer than R_BACKEND_LINE_LIMIT
+                truncated = True
+                continue
+            if not line:
+                # R exited mid-job, e.g. the script called quit()
+                status = str(await self.proc.wait())
+                break
+            if line.startswith(prefix):
+                status = line[len(prefix):].decode("utf-8", errors="replace").strip()
+                break
+            # Keep reading to the sentinel, but only hold on to R_OUTPUT_LIMIT bytes
+            room = R_OUTPUT_LIMIT - len(stray_output)
+            if len(line) > room:
+                truncated = True
+                line = line[:room]
+            stray_output += line
+        return status, _decode_output(bytes(stray_output), truncated), truncated
+
+    def close(self, force: bool = False) -> None:
+        """Stop the R process and remove job files"""
+        if self.is_alive():
+            if force:
+                _kill_process_group(self.proc)
+            else:
+                # R exits on its own once stdin reaches EOF
+                self.proc.stdin.close()
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+    async def wait_closed(self, timeout: float = 2) -> None:
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            _kill_process_group(self.proc)
+            await self.proc.wait()
+
+def _kill_process_group(proc: asyncio.subprocess.Process) -> None:
+    """Kill a child started in its own session, together with anything it spawned"""
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+
+def compute_config_hash(workdir: Path, env: Dict[str, str], r_exe: str, preload: Optional[List[str]] = None) -> str:
+    """Hash the settings that make two R sessions interchangeable"""
+    config = {
+        "workdir": str(workdir),
+        "env": {key: env[key] for key in sorted(R_SESSION_ENV_KEYS) if key in env},
+        "r_exe": r_exe,
+        "preload": preload or []
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+class RSessionPool:
+    """Persistent R sessions keyed by configuration hash, reused across calls"""
+
+    def __init__(self, max_sessions: int = R_SESSION_POOL_SIZE, idle_timeout: float = R_BACKEND_IDLE_TIMEOUT):
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[str, List[RBackend]] = {}
+        self._busy: Dict[str, Tuple[str, RBackend]] = {}
+        # Sessions whose factory is still running; they count toward the cap
+        self._starting = 0
+        self._cleanup_task: Optional[asyncio.Task] = None
+
+    @property
+    def borrowers(self) -> Set[str]:
+        """Call ids currently holding a session"""
+        return set(self._busy)
+
+    def size(self) -> int:
+        return self._starting + len(self._busy) + sum(len(sessions) for sessions in self._idle.values())
+
+    async def acquire(self, key: str, factory: Callable[[], Awaitable[RBackend]], call_id: str) -> Optional[RBackend]:
+        """Hand out an idle session for key, or start one while under the cap"""
+        session = None
+        idle = self._idle.get(key, [])
+        while idle and session is None:
+            candidate = idle.pop()
+            if candidate.is_alive():
+                session = candidate
+            else:
+                candidate.close()
+        
+        if session is None:
+            if self.size() >= self.max_sessions and not self._evict_lru():
+                return None
+            # Reserve the slot before yielding so concurrent acquires see it
+            self._starting += 1
+            try:
+                session = await factory()
+            finally:
+                self._starting -= 1
+        
+        self._busy[call_id] = (key, session)
+        self._ensure_cleanup_task()
+        return session
+
+    def release(self, call_id: str, discard: bool = False) -> None:
+        """Return a borrowed session to the pool, or close it if discarded"""
+        borrowed = self._busy.pop(call_id, None)
+        if borrowed is None:
+            return
+        key, session = borrowed
+        if discard or not session.is_alive():
+            session.close(force=True)
+            return
+        session.last_used = time.time()
+        self._idle.setdefault(key, []).append(session)
+
+    def _evict_lru(self) -> bool:
+        """Close the least recently used idle session to make room"""
+        candidates = [(session.last_used, key, session) for key, sessions in self._idle.items() for session in sessions]
+        if not candidates:
+            return False
+        _, key, session = min(candidates, key=lambda item: item[0])
+        self._idle[key].remove(session)
+        session.close()
+        return True
+
+    def close_idle(self, older_than: float = 0.0, workdir: Optional[Path] = None) -> None:
+        """Close idle sessions unused for at least older_than seconds, optionally only those in workdir"""
+        now = time.time()
+        for key in list(self._idle):
+            keep = []
+            for session in self._idle[key]:
+                if now - session.last_used >= older_than and workdir in (None, session.workdir):
+                    session.close()
+                else:
+                    keep.append(session)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    async def close_all(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+            self._cleanup_task = None
+        sessions = [session for idle in self._idle.values() for session in idle]
+        sessions += [session for _, session in self._busy.values()]
+        self.close_idle()
+        for call_id in list(self._busy):
+            self.release(call_id, discard=True)
+        await asyncio.gather(*(session.wait_closed() for session in sessions))
+
+    def _ensure_cleanup_task(self) -> None:
+        if self._cleanup_task and not self._cleanup_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._cleanup_task = loop.create_task(self._cleanup_idle())
+
+    async def _cleanup_idle(self) -> None:
+        while self.size():
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.close_idle(older_than=self.idle_timeout)
+
+def _read_head(path: Path, max_bytes: int) -> Tuple[memoryview, int]:
+    """Read up to max_bytes from the start of a file, returning the data and file size"""
+    # Unbuffered reads land directly in one preallocated buffer, with no intermediate copies
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        buf = memoryview(bytearray(size if max_bytes < 0 else min(max_bytes, size)))
+        filled = 0
+        while filled < len(buf):
+            n = f.readinto(buf[filled:])
+            if not n:
+                break
+            filled += n
+        return buf[:filled], size
+
+def _mount_table() -> List[Tuple[str, str]]:
+    """(mount point, filesystem type) for each mounted filesystem, empty if unknown"""
+    try:
+        with open("/proc/self/mounts") as f:
+            # Linux; spaces in mount points are escaped as \\040
+            return [
+                (fields[1].replace("\\040", " "), fields[2])
+                for fields in (line.split() for line in f) if len(fields) >= 3
+            ]
+    except OSError:
+        pass
+    if sys.platform == "darwin":
+        # macOS has no /proc; mount prints "device on /point (type, options...)"
+        try:
+            output = subprocess.run(["/sbin/mount"], capture_output=True, text=True, timeout=2).stdout
+        except (OSError, subprocess.SubprocessError):
+            return []
+        return [(m.group(1), m.group(2)) for m in map(_MOUNT_LINE_RE.match, output.splitlines()) if m]
+    return []
+
+def _is_remote_filesystem(path: Path) -> bool:
+    """Whether path lives on a network filesystem, judged from the mount table"""
+    target = str(path)
+    best, best_type = "", ""
+    for mount_point, fs_type in _mount_table():
+        prefix = mount_point.rstrip("/") + "/"
+        if (target == mount_point or target.startswith(prefix)) and len(mount_point) > len(best):
+            best, best_type = mount_point, fs_type
+    return best_type in REMOTE_FS_TYPES
+
+def _stat_regular_file(path: bytes) -> Optional[os.stat_result]:
+    """stat() a path, returning None unless it is a regular file"""
+    try:
+        result = os.stat(path)
+    except OSError:
+        return None
+    return result if stat.S_ISREG(result.st_mode) else None
+
+def _read_table_head(path: Path, delimiter: str, max_rows: int) -> Tuple[Optional[List[str]], List[List[str]], bool]:
+    """Parse a delimited file's header and first rows; headers is None if the file is empty"""
+    with open(path, 'r', newline='', encoding='utf-8', buffering=CSV_PREVIEW_BUFFER_SIZE) as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        headers = next(reader, None)
+        if headers is None:
+            return None, [], False
+        # Read one row past the limit to tell whether anything was cut off
+        rows = list(itertools.islice(reader, max_rows + 1))
+    truncated = len(rows) > max_rows
+    return headers, rows[:max_rows], truncated
+
+def _line_count(content: str) -> int:
+    """Count lines in a string without building a list of them"""
+    return content.count('\n') + (1 if content and not content.endswith('\n') else 0)
+
+def _count_file_lines(path: Path) -> int:
+    """Count lines by scanning raw bytes in chunks, without decoding the file"""
+    lines = 0
+    last = b""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    return lines + (1 if last and last != b"\n" else 0)
+
+@functools.lru_cache(maxsize=1)
+def _resolve_r() -> Tuple[Optional[str], Optional[str]]:
+    """Locate Rscript and R on PATH once; returns (rscript, r)"""
+    return shutil.which("Rscript"), shutil.which("R")
+
+def _find_r_executable() -> Optional[str]:
+    rscript, r_exe = _resolve_r()
+    return rscript or r_exe
+
+class ExpressionBatcher:
+    """Coalesces R expressions submitted close together into one session round-trip"""
+
+    def __init__(self,
+                 runner: Callable[[Path, List[str], int, Callable[[int, Dict[str, Any]], None]],
+                                  Awaitable[Optional[List[Dict[str, Any]]]]],
+                 window: float = R_BATCH_WINDOW, max_size: int = R_BATCH_MAX_SIZE):
+        self.runner = runner
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[Path, List[Tuple[str, int, asyncio.Future]]] = {}
+        self._flush_handles: Dict[Path, asyncio.TimerHandle] = {}
+
+    def submit(self, workdir: Path, expr: str, timeout: int) -> "asyncio.Future[Optional[Dict[str, Any]]]":
+        """Queue an expression; the future resolves to its result, or None if it was not batched"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(workdir, [])
+        pending.append((expr, timeout, future))
+        if len(pending) >= self.max_size:
+            self._flush(workdir)
+        elif workdir not in self._flush_handles:
+            self._flush_handles[workdir] = loop.call_later(self.window, self._flush, workdir)
+        return future
+
+    def _flush(self, workdir: Path) -> None:
+        handle = self._flush_handles.pop(workdir, None)
+        if handle:
+            handle.cancel()
+        batch = self._pending.pop(workdir, [])
+        if batch:
+            asyncio.get_running_loop().create_task(self._run(workdir, batch))
+
+    async def _run(self, workdir: Path, batch: List[Tuple[str, int, asyncio.Future]]) -> None:
+        def resolve(i: int, result: Dict[str, Any]) -> None:
+            # Hand each caller its result as soon as its expression finishes
+            future = batch[i][2]
+            if not future.done():
+                future.set_result(result)
+
+        try:
+            # Each caller enforces its own timeout, so the batch only needs the longest
+            results = await self.runner(workdir, [expr for expr, _, _ in batch], max(timeout for _, timeout, _ in batch), resolve)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for i, (_, _, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(results[i] if results else None)
+
 class TidyBrainServer:
-    def __init__(self):
+    def __init__(self, durable_writes: bool = False):
         self.state_dir = None
         self.state_file = None
         self.workdir = None
+        self._workdir_resolved = None
+        self._workdir_remote = False
+        # Environment for R processes, composed once per workdir
+        self._r_env: Optional[Dict[str, str]] = None
+        # path -> (st_mtime_ns, st_size, lines) for R files this server wrote, so
+        # appends can report total_lines without reading the file back
+        self._line_counts: Dict[Path, Tuple[int, int, int]] = {}
+        # (taken_at, [(name, size, mtime), ...]) for the workdir's regular files,
+        # with names kept as bytes so only matching entries are ever decoded
+        self._wd_snapshot: Optional[Tuple[float, List[Tuple[bytes, int, float]]]] = None
+        self._wd_snapshot_generation = 0
         self.primary_file = "agent.R"  # Changed from .r to .R
-        
+        self.r_sessions = RSessionPool()
+        self._r_result_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.expression_batcher = ExpressionBatcher(self.run_r_batch)
+        # In-memory copy of state.json; writes are debounced unless durable_writes is set
+        self.durable_writes = durable_writes
+        self._state_cache: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._state_flush_handle: Optional[asyncio.TimerHandle] = None
+        atexit.register(self.flush_state)
+
     def load_state(self) -> Dict[str, Any]:
-        """Load state from JSON file"""
-        if not self.state_file or not self.state_file.exists():
+        """Load state, reading the JSON file only on first use"""
+        if not self.state_file:
+            return {}
+        if self._state_cache is None:
+            self._state_cache = self._read_state_file()
+        return dict(self._state_cache)
+    
+    def _read_state_file(self) -> Dict[str, Any]:
+        if not self.state_file.exists():
             return {}
         try:
-            with open(self.state_file, 'r') as f:
-                return json.load(f)
+            data = self.state_file.read_bytes()
+            return orjson.loads(data) if orjson else json.loads(data)
         except Exception as e:
             logger.warning(f"Failed to load state: {e}")
             return {}
     
-    def save_state(self, state: Dict[str, Any]) -> None:
-        """Save state to JSON file with atomic write"""
+    def save_state(self, state: Dict[str, Any], durable: bool = False) -> None:
+        """Update state, writing it to disk shortly after unless durable is requested"""
         if not self.state_file:
             return
+        self._state_cache = dict(state)
+        self._state_dirty = True
+        if durable or self.durable_writes:
+            self.flush_state()
+            return
+        if self._state_flush_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush_state()
+                return
+            self._state_flush_handle = loop.call_later(STATE_FLUSH_DELAY, self.flush_state)
+    
+    def flush_state(self) -> None:
+        """Write pending state to JSON file with atomic write"""
+        if self._state_flush_handle:
+            self._state_flush_handle.cancel()
+            self._state_flush_handle = None
+        if not self._state_dirty or not self.state_file:
+            return
+        self._state_dirty = False
+        state = self._state_cache
         temp_file = self.state_file.with_suffix('.tmp')
         try:
-            with open(temp_file, 'w') as f:
-                json.dump(state, f, indent=2, default=str)
+            if orjson:
+                data = orjson.dumps(state, option=orjson.OPT_INDENT_2, default=str)
+            else:
+                data = json.dumps(state, indent=2, default=str).encode('utf-8')
+            temp_file.write_bytes(data)
             temp_file.replace(self.state_file)
         except Exception as e:
             logger.error(f"Failed to save state: {e}")
@@ -144,31 +995,82 @@ class TidyBrainServer:
         if not self.workdir:
             return False
         try:
-            resolved = path.resolve()
-            # For Python 3.8 compatibility
-            try:
-                return resolved.is_relative_to(self.workdir)
-            except AttributeError:
-                # Fallback for Python < 3.9
-                try:
-                    resolved.relative_to(self.workdir)
-                    return True
-                except ValueError:
-                    return False
+            workdir = str(self._workdir_resolved)
+            return os.path.commonpath([workdir, str(path.resolve())]) == workdir
         except (ValueError, RuntimeError):
             return False
     
+    def _normalize_r_path(self, filename: str) -> Tuple[str, Path, Optional[Dict[str, Any]]]:
+        """Add the .R extension if missing and check the file stays within workdir"""
+        if not filename.endswith(('.R', '.r')):
+            filename = filename + '.R'
+        file_path = self.workdir / filename
+        if not self.is_safe_path(file_path):
+            return filename, file_path, {
+                "code": "UNSAFE_PATH",
+                "message": f"File path {filename} is outside working directory"
+            }
+        return filename, file_path, None
+    
     def find_r_executable(self) -> Optional[str]:
         """Find R executable, preferring Rscript"""
-        rscript = shutil.which("Rscript")
-        if rscript:
-            return rscript
-        r_exe = shutil.which("R")
-        if r_exe:
-            return r_exe
+        return _find_r_executable()
+    
+    def invalidate_r_cache(self) -> None:
+        """Forget the cached R executable, e.g. after PATH changes"""
+        _resolve_r.cache_clear()
+    
+    async def acquire_r_session(self, call_id: str, workdir: Optional[Path] = None) -> Optional[RBackend]:
+        """Borrow a persistent R session matching the workdir and environment"""
+        workdir = workdir or self.workdir
+        r_bin = _resolve_r()[1]
+        if not r_bin:
+            return None
+        if workdir == self.workdir:
+            env = self._r_env
+        else:
+            env = {**os.environ, "R_LIBS_USER": str(workdir / "R_libs")}
+        preload = self.load_state().get("preload_packages", R_PRELOAD_PACKAGES)
+        key = compute_config_hash(workdir, env, r_bin, preload)
+        try:
+            return await self.r_sessions.acquire(key, lambda: RBackend.start(r_bin, workdir, env, preload), call_id)
+        except Exception as e:
+            logger.warning(f"Failed to start persistent R session: {e}")
+            return None
+    
+    def _r_cache_key(self, *parts: str) -> str:
+        """Key R results on their inputs, the R executable and the workdir"""
+        digest = hashlib.blake2b("\0".join(parts).encode("utf-8")).hexdigest()
+        return f"{digest}:{self.find_r_executable()}:{self.workdir}"
+    
+    def _lookup_r_result(self, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        if key is None or key not in self._r_result_cache:
+            return None
+        self._r_result_cache.move_to_end(key)
+        return dict(self._r_result_cache[key])
+    
+    def _remember_r_result(self, key: Optional[str], result: Dict[str, Any]) -> None:
+        """Store a successful R result, evicting the least recently used entry"""
+        if key is None or not result.get("ok"):
+            return
+        self._r_result_cache[key] = dict(result)
+        self._r_result_cache.move_to_end(key)
+        while len(self._r_result_cache) > R_RESULT_CACHE_SIZE:
+            self._r_result_cache.popitem(last=False)
+    
+    @staticmethod
+    def _backend_job(args: List[str]) -> Optional[Dict[str, Any]]:
+        """Translate Rscript arguments into a persistent session job, if possible"""
+        if len(args) == 2 and args[0] == "-e":
+            return {"code": args[1]}
+        save_rdata = bool(args) and args[0] == "--save"
+        rest = args[1:] if save_rdata else args
+        # Scripts with trailing arguments rely on commandArgs(), so keep them on Rscript
+        if len(rest) == 1 and not rest[0].startswith("-"):
+            return {"file": Path(rest[0]), "save_rdata": save_rdata}
         return None
     
-    def run_r_command(self, args: List[str], timeout: int = 120) -> Dict[str, Any]:
+    async def run_r_command(self, args: List[str], timeout: int = 120, no_share: bool = False) -> Dict[str, Any]:
         """Execute R command and capture output"""
         r_exe = self.find_r_executable()
         if not r_exe:
@@ -181,26 +1083,62 @@ class TidyBrainServer:
                 }
             }
         
+        call_id = uuid.uuid4().hex
+        job = None if no_share else self._backend_job(args)
+        backend = await self.acquire_r_session(call_id) if job is not None else None
         start_time = time.time()
         try:
-            result = subprocess.run(
-                [r_exe] + args,
-                capture_output=True,
-                text=True,
-                cwd=self.workdir,
-                timeout=timeout,
-                env={**os.environ, "R_LIBS_USER": str(self.workdir / "R_libs")}
+            if backend:
+                try:
+                    return await backend.run(timeout, **job)
+                except ConnectionError as e:
+                    logger.warning(f"Persistent R session failed, falling back to Rscript: {e}")
+                    self.r_sessions.release(call_id, discard=True)
+                    start_time = time.time()
+            
+            # Own session so a timeout can kill R together with its children
+            proc = await asyncio.create_subprocess_exec(
+                r_exe, *args,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                cwd=str(self.workdir),
+                env=self._r_env,
+                start_new_session=True
+            )
+            gathered = asyncio.gather(
+                _read_stream_capped(proc.stdout, R_OUTPUT_LIMIT),
+                _read_stream_capped(proc.stderr, R_OUTPUT_LIMIT),
+                proc.wait()
             )
+            try:
+                (stdout, truncated_stdout), (stderr, truncated_stderr), _ = await asyncio.wait_for(gathered, timeout)
+            except asyncio.TimeoutError:
+                _kill_process_group(proc)
+                await proc.wait()
+                raise
+            except asyncio.CancelledError:
+                # The caller went away; do not leave R running unattended
+                _kill_process_group(proc)
+                # Retrieve the gather's outcome so it is not logged as never retrieved
+                gathered.cancel()
+                try:
+                    await gathered
+                except (asyncio.CancelledError, Exception):
+                    pass
+                raise
             elapsed = time.time() - start_time
             
             return {
-                "ok": result.returncode == 0,
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode,
+                "ok": proc.returncode == 0,
+                "stdout": _decode_output(stdout, truncated_stdout),
+                "stderr": _decode_output(stderr, truncated_stderr),
+                "truncated_stdout": truncated_stdout,
+                "truncated_stderr": truncated_stderr,
+                "returncode": proc.returncode,
                 "elapsed_seconds": elapsed
             }
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
+            self.r_sessions.release(call_id, discard=True)
             return {
                 "ok": False,
                 "error": {
@@ -209,7 +1147,12 @@ class TidyBrainServer:
                     "hints": ["Increase timeout_sec parameter", "Check for infinite loops in your code"]
                 }
             }
+        except asyncio.CancelledError:
+            # The session may be mid-job, so it cannot go back to the pool
+            self.r_sessions.release(call_id, discard=True)
+            raise
         except Exception as e:
+            self.r_sessions.release(call_id, discard=True)
             return {
                 "ok": False,
                 "error": {
@@ -217,33 +1160,59 @@ class TidyBrainServer:
                     "message": f"Failed to execute R command: {str(e)}"
                 }
             }
+        finally:
+            self.r_sessions.release(call_id)
+    
+    async def run_r_batch(self, workdir: Path, exprs: List[str], timeout: int,
+                          on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None) -> Optional[List[Dict[str, Any]]]:
+        """Evaluate several expressions in one persistent session round-trip, None if no session is available"""
+        call_id = uuid.uuid4().hex
+        backend = await self.acquire_r_session(call_id, workdir)
+        if backend is None:
+            return None
+        try:
+            results = await backend.run_batch(timeout, exprs, on_result)
+            if None in results:
+                # R is still running the expression that timed out
+                self.r_sessions.release(call_id, discard=True)
+            return [result or {
+                "ok": False,
+                "error": {
+                    "code": "TIMEOUT",
+                    "message": f"Batched R expressions timed out after {timeout} seconds",
+                    "hints": ["Increase timeout_sec parameter", "Set allow_batching=false to run the expression on its own"]
+                }
+            } for result in results]
+        except ConnectionError as e:
+            logger.warning(f"Persistent R session failed while batching: {e}")
+            self.r_sessions.release(call_id, discard=True)
+            return None
+        except asyncio.CancelledError:
+            self.r_sessions.release(call_id, discard=True)
+            raise
+        finally:
+            self.r_sessions.release(call_id)
     
     def optimize_ggplot_code(self, code: str) -> Tuple[str, List[str]]:
         """Apply style guide optimizations to ggplot code"""
-        optimized = code
-        changes = []
-        
-        # Replace <- with = for assignments
-        if '<-' in optimized:
-            optimized = optimized.replace('<-', '=')
-            changes.append("Replaced <- with = for assignments")
-        
-        # Replace theme_gray with theme_minimal
-        if 'theme_gray()' in optimized or 'theme_grey()' in optimized:
-            optimized = optimized.replace('theme_gray()', 'theme_minimal(base_size=14)')
-            optimized = optimized.replace('theme_grey()', 'theme_minimal(base_size=14)')
-            changes.append("Replaced default theme with theme_minimal(base_size=14)")
+        applied = set()
+        parts = []
+        pos = 0
         
-        # Check for ggsave and ensure proper dpi
-        if 'ggsave(' in optimized and 'dpi=' not in optimized:
-            optimized = optimized.replace('ggsave(', 'ggsave(dpi=800, ')
-            changes.append("Added dpi=800 to ggsave for high quality output")
-        
-        # Check for default dimensions
-        if 'ggsave(' in optimized and 'width=' not in optimized:
-            optimized = optimized.replace('ggsave(', 'ggsave(width=5, height=4, ')
-            changes.append("Added optimal dimensions (5x4 inches) to ggsave")
+        for match in _GGPLOT_SUB_RE.finditer(code):
+            start, end = match.span()
+            parts.append(code[pos:start])
+            pos = end
+            replacement = _GGPLOT_REPLACEMENTS[match.lastgroup]
+            if callable(replacement):
+                parts.append(replacement(code, end, applied))
+            else:
+                applied.add(match.lastgroup)
+                parts.append(replacement)
+        parts.append(code[pos:])
         
+        optimized = ''.join(parts)
+        changes = [message for key, message in _GGPLOT_CHANGE_MESSAGES if key in applied]
         return optimized, changes
     
     async def handle_set_workdir(self, path: str, create: bool = True) -> Dict[str, Any]:
@@ -272,7 +1241,24 @@ class TidyBrainServer:
                     }
                 }
             
+            # Detection may shell out to mount on macOS, so keep it off the event loop
+            loop = asyncio.get_running_loop()
+            workdir_remote = await loop.run_in_executor(None, _is_remote_filesystem, workdir)
+            
+            # Persist pending state for the previous workdir before switching files
+            self.flush_state()
+            if self.workdir is not None and self.workdir != workdir:
+                # Warm R sessions for the old workdir will not be borrowed again soon
+                self.r_sessions.close_idle(workdir=self.workdir)
+            self._state_cache = None
+            self._r_result_cache.clear()
+            
             self.workdir = workdir
+            # Path(path).resolve() above, kept for is_safe_path containment checks
+            self._workdir_resolved = workdir
+            self._workdir_remote = workdir_remote
+            self._r_env = {**os.environ, "R_LIBS_USER": str(workdir / "R_libs")}
+            self._invalidate_workdir_snapshot()
             self.state_dir = workdir / ".TidyBrain"
             self.state_dir.mkdir(exist_ok=True)
             self.state_file = self.state_dir / "state.json"
@@ -309,7 +1295,7 @@ class TidyBrainServer:
             "r_executable": self.find_r_executable()
         }
         
-        if self.state_file and self.state_file.exists():
+        if self.state_file:
             saved_state = self.load_state()
             state.update(saved_state)
         
@@ -321,19 +1307,9 @@ class TidyBrainServer:
         if not ok:
             return {"ok": False, "error": error}
         
-        # Ensure .R extension
-        if not filename.endswith(('.R', '.r')):
-            filename = filename + '.R'
-        
-        file_path = self.workdir / filename
-        if not self.is_safe_path(file_path):
-            return {
-                "ok": False,
-                "error": {
-                    "code": "UNSAFE_PATH",
-                    "message": f"File path {filename} is outside working directory"
-                }
-            }
+        filename, file_path, error = self._normalize_r_path(filename)
+        if error:
+            return {"ok": False, "error": error}
         
         if file_path.exists() and not overwrite:
             return {
@@ -348,6 +1324,8 @@ class TidyBrainServer:
         try:
             content = R_SCAFFOLD if scaffold else ""
             file_path.write_text(content)
+            self._remember_line_count(file_path, os.stat(file_path), _line_count(content))
+            self._invalidate_workdir_snapshot()
             
             return {
                 "ok": True,
@@ -372,16 +1350,9 @@ class TidyBrainServer:
         if not ok:
             return {"ok": False, "error": error}
         
-        # Ensure .R extension
-        if not old_name.endswith(('.R', '.r')):
-            old_name = old_name + '.R'
-        if not new_name.endswith(('.R', '.r')):
-            new_name = new_name + '.R'
-        
-        old_path = self.workdir / old_name
-        new_path = self.workdir / new_name
-        
-        if not self.is_safe_path(old_path) or not self.is_safe_path(new_path):
+        old_name, old_path, old_error = self._normalize_r_path(old_name)
+        new_name, new_path, new_error = self._normalize_r_path(new_name)
+        if old_error or new_error:
             return {
                 "ok": False,
                 "error": {
@@ -413,6 +1384,9 @@ class TidyBrainServer:
             if new_path.exists():
                 new_path.unlink()
             old_path.rename(new_path)
+            self._line_counts.pop(old_path, None)
+            self._line_counts.pop(new_path, None)
+            self._invalidate_workdir_snapshot()
             
             # Update primary file if it was renamed
             if self.primary_file == old_name:
@@ -444,19 +1418,9 @@ class TidyBrainServer:
         if not ok:
             return {"ok": False, "error": error}
         
-        # Ensure .R extension
-        if not filename.endswith(('.R', '.r')):
-            filename = filename + '.R'
-        
-        file_path = self.workdir / filename
-        if not self.is_safe_path(file_path):
-            return {
-                "ok": False,
-                "error": {
-                    "code": "UNSAFE_PATH",
-                    "message": f"File path {filename} is outside working directory"
-                }
-            }
+        filename, file_path, error = self._normalize_r_path(filename)
+        if error:
+            return {"ok": False, "error": error}
         
         if not file_path.exists():
             return {
@@ -480,7 +1444,18 @@ class TidyBrainServer:
             }
         }
     
-    async def handle_append_r_code(self, code: str, filename: Optional[str] = None, ensure_trailing_newline: bool = True) -> Dict[str, Any]:
+    def _remember_line_count(self, path: Path, st: os.stat_result, lines: int) -> None:
+        """Record a file's line count against its current mtime and size"""
+        self._line_counts[path] = (st.st_mtime_ns, st.st_size, lines)
+    
+    def _known_line_count(self, path: Path, st: os.stat_result) -> Optional[int]:
+        """Cached line count for path, if the file is unchanged since it was recorded"""
+        cached = self._line_counts.get(path)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            return cached[2]
+        return None
+    
+    async def handle_append_r_code(self, code: str, filename: Optional[str] = None, ensure_trailing_newline: bool = True, count_lines: bool = False) -> Dict[str, Any]:
         """Append code to R file"""
         ok, error = self.ensure_workdir_set()
         if not ok:
@@ -489,19 +1464,9 @@ class TidyBrainServer:
         if filename is None:
             filename = self.primary_file
         
-        # Ensure .R extension
-        if not filename.endswith(('.R', '.r')):
-            filename = filename + '.R'
-        
-        file_path = self.workdir / filename
-        if not self.is_safe_path(file_path):
-            return {
-                "ok": False,
-                "error": {
-                    "code": "UNSAFE_PATH",
-                    "message": f"File path {filename} is outside working directory"
-                }
-            }
+        filename, file_path, error = self._normalize_r_path(filename)
+        if error:
+            return {"ok": False, "error": error}
         
         if not file_path.exists():
             return {
@@ -514,25 +1479,46 @@ class TidyBrainServer:
             }
         
         try:
-            existing_content = file_path.read_text()
-            
-            # Ensure existing content ends with newline
-            if existing_content and not existing_content.endswith('\n'):
-                existing_content += '\n'
-            
             # Ensure code ends with newline if requested
             if ensure_trailing_newline and code and not code.endswith('\n'):
                 code += '\n'
             
-            new_content = existing_content + code
-            file_path.write_text(new_content)
+            # Write only the new code instead of rewriting the whole file
+            with open(file_path, 'r+b') as f:
+                previous_lines = self._known_line_count(file_path, os.fstat(f.fileno()))
+                size = f.seek(0, os.SEEK_END)
+                needs_newline = False
+                if size:
+                    f.seek(-1, os.SEEK_END)
+                    # Ensure existing content ends with newline
+                    needs_newline = f.read(1) != b'\n'
+                f.seek(0, os.SEEK_END)
+                if needs_newline:
+                    f.write(b'\n')
+                f.write(code.encode('utf-8'))
+            self._invalidate_workdir_snapshot()
+            
+            # A separator newline completes the previous last line, so the
+            # total grows by exactly the appended code's line count
+            lines_appended = _line_count(code)
+            if previous_lines is not None:
+                total_lines = previous_lines + lines_appended
+            elif count_lines:
+                total_lines = _count_file_lines(file_path)
+            else:
+                # Unknown without reading the file back; opt in with count_lines
+                total_lines = None
+            if total_lines is None:
+                self._line_counts.pop(file_path, None)
+            else:
+                self._remember_line_count(file_path, os.stat(file_path), total_lines)
             
             return {
                 "ok": True,
                 "data": {
                     "filename": filename,
-                    "lines_appended": len(code.splitlines()),
-                    "total_lines": len(new_content.splitlines())
+                    "lines_appended": lines_appended,
+                    "total_lines": total_lines
                 }
             }
         except Exception as e:
@@ -553,19 +1539,9 @@ class TidyBrainServer:
         if filename is None:
             filename = self.primary_file
         
-        # Ensure .R extension
-        if not filename.endswith(('.R', '.r')):
-            filename = filename + '.R'
-        
-        file_path = self.workdir / filename
-        if not self.is_safe_path(file_path):
-            return {
-                "ok": False,
-                "error": {
-                    "code": "UNSAFE_PATH",
-                    "message": f"File path {filename} is outside working directory"
-                }
-            }
+        filename, file_path, error = self._normalize_r_path(filename)
+        if error:
+            return {"ok": False, "error": error}
         
         if file_path.exists() and not overwrite:
             return {
@@ -585,13 +1561,15 @@ class TidyBrainServer:
                 content = code
             
             file_path.write_text(content)
+            self._remember_line_count(file_path, os.stat(file_path), _line_count(content))
+            self._invalidate_workdir_snapshot()
             
             return {
                 "ok": True,
                 "data": {
                     "filename": filename,
                     "path": str(file_path),
-                    "lines_written": len(content.splitlines()),
+                    "lines_written": _line_count(content),
                     "scaffold_used": use_scaffold_header
                 }
             }
@@ -604,7 +1582,7 @@ class TidyBrainServer:
                 }
             }
     
-    async def handle_run_r_script(self, filename: Optional[str] = None, args: Optional[List[str]] = None, timeout_sec: int = 120, save_rdata: bool = True) -> Dict[str, Any]:
+    async def handle_run_r_script(self, filename: Optional[str] = None, args: Optional[List[str]] = None, timeout_sec: int = 120, save_rdata: bool = True, no_share: bool = False, pure: bool = False, cache_bust: bool = False) -> Dict[str, Any]:
         """Run R script"""
         ok, error = self.ensure_workdir_set()
         if not ok:
@@ -613,19 +1591,9 @@ class TidyBrainServer:
         if filename is None:
             filename = self.primary_file
         
-        # Ensure .R extension
-        if not filename.endswith(('.R', '.r')):
-            filename = filename + '.R'
-        
-        file_path = self.workdir / filename
-        if not self.is_safe_path(file_path):
-            return {
-                "ok": False,
-                "error": {
-                    "code": "UNSAFE_PATH",
-                    "message": f"File path {filename} is outside working directory"
-                }
-            }
+        filename, file_path, error = self._normalize_r_path(filename)
+        if error:
+            return {"ok": False, "error": error}
         
         if not file_path.exists():
             return {
@@ -645,7 +1613,18 @@ class TidyBrainServer:
         if args:
             cmd_args.extend(args)
         
-        result = self.run_r_command(cmd_args, timeout_sec)
+        # Pure scripts are cached until the file changes
+        cache_key = None
+        if pure:
+            st = file_path.stat()
+            cache_key = self._r_cache_key("script", str(file_path), str(st.st_mtime_ns), str(st.st_size), json.dumps(args or []), str(save_rdata))
+        result = None if cache_bust else self._lookup_r_result(cache_key)
+        cached = result is not None
+        if not cached:
+            result = await self.run_r_command(cmd_args, timeout_sec, no_share=no_share)
+            self._remember_r_result(cache_key, result)
+            # The script may have written exports
+            self._invalidate_workdir_snapshot()
         
         if result.get("ok"):
             return {
@@ -654,24 +1633,51 @@ class TidyBrainServer:
                     "filename": filename,
                     "stdout": result.get("stdout", ""),
                     "stderr": result.get("stderr", ""),
+                    "truncated_stdout": result.get("truncated_stdout", False),
+                    "truncated_stderr": result.get("truncated_stderr", False),
                     "elapsed_seconds": result.get("elapsed_seconds", 0),
-                    "rdata_saved": save_rdata
+                    "rdata_saved": save_rdata,
+                    "cached": cached
                 }
             }
         else:
             error_info = result.get("error", {})
             error_info["filename"] = filename
+            error_info["stdout"] = result.get("stdout", "")
             error_info["stderr"] = result.get("stderr", "")
             return {"ok": False, "error": error_info}
     
-    async def handle_run_r_expression(self, expr: str, timeout_sec: int = 60) -> Dict[str, Any]:
+    async def handle_run_r_expression(self, expr: str, timeout_sec: int = 60, no_share: bool = False, pure: bool = False, cache_bust: bool = False, allow_batching: bool = False) -> Dict[str, Any]:
         """Run single R expression"""
         ok, error = self.ensure_workdir_set()
         if not ok:
             return {"ok": False, "error": error}
         
-        # Use -e flag for expression evaluation
-        result = self.run_r_command(["-e", expr], timeout_sec)
+        # Only expressions marked pure are safe to serve from cache
+        cache_key = self._r_cache_key("expr", expr) if pure else None
+        result = None if cache_bust else self._lookup_r_result(cache_key)
+        cached = result is not None
+        if not cached:
+            if allow_batching and not no_share and not R_BATCH_UNSAFE_RE.search(expr):
+                try:
+                    # shield() keeps this caller's timeout from cancelling the shared batch
+                    result = await asyncio.wait_for(
+                        asyncio.shield(self.expression_batcher.submit(self.workdir, expr, timeout_sec)), timeout_sec
+                    )
+                except asyncio.TimeoutError:
+                    result = {
+                        "ok": False,
+                        "error": {
+                            "code": "TIMEOUT",
+                            "message": f"R command timed out after {timeout_sec} seconds",
+                            "hints": ["Increase timeout_sec parameter", "Set allow_batching=false to run the expression on its own"]
+                        }
+                    }
+            if result is None:
+                # Use -e flag for expression evaluation
+                result = await self.run_r_command(["-e", expr], timeout_sec, no_share=no_share)
+            self._remember_r_result(cache_key, result)
+            self._invalidate_workdir_snapshot()
         
         if result.get("ok"):
             return {
@@ -680,15 +1686,69 @@ class TidyBrainServer:
                     "expression": expr,
                     "stdout": result.get("stdout", ""),
                     "stderr": result.get("stderr", ""),
-                    "elapsed_seconds": result.get("elapsed_seconds", 0)
+                    "truncated_stdout": result.get("truncated_stdout", False),
+                    "truncated_stderr": result.get("truncated_stderr", False),
+                    "elapsed_seconds": result.get("elapsed_seconds", 0),
+                    "cached": cached
                 }
             }
         else:
             error_info = result.get("error", {})
             error_info["expression"] = expr
+            error_info["stdout"] = result.get("stdout", "")
             error_info["stderr"] = result.get("stderr", "")
             return {"ok": False, "error": error_info}
     
+    def _scan_workdir(self) -> List[Tuple[bytes, int, float]]:
+        """List (name, size, mtime) for the regular files in the working directory"""
+        files = []
+        root = os.fsencode(self.workdir)
+        if self._workdir_remote:
+            # On network mounts each stat() is a round trip, so overlap them
+            names = os.listdir(root)
+            paths = [os.path.join(root, name) for name in names]
+            with ThreadPoolExecutor(max_workers=REMOTE_STAT_WORKERS) as pool:
+                stats = list(pool.map(_stat_regular_file, paths))
+            for name, st in zip(names, stats):
+                if st is not None:
+                    files.append((name, st.st_size, st.st_mtime))
+        else:
+            # One directory pass; DirEntry caches file type from the listing
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        st = entry.stat()
+                        files.append((entry.name, st.st_size, st.st_mtime))
+        return files
+    
+    async def _snapshot_workdir(self) -> List[Tuple[bytes, int, float]]:
+        """Workdir listing shared by the listing tools, rescanned after WORKDIR_SNAPSHOT_TTL"""
+        now = time.monotonic()
+        if self._wd_snapshot and now - self._wd_snapshot[0] < WORKDIR_SNAPSHOT_TTL:
+            return self._wd_snapshot[1]
+        generation = self._wd_snapshot_generation
+        # Walk the directory off the event loop
+        loop = asyncio.get_running_loop()
+        files = await loop.run_in_executor(None, self._scan_workdir)
+        # Skip caching if a write invalidated the listing while it was taken
+        if generation == self._wd_snapshot_generation:
+            self._wd_snapshot = (now, files)
+        return files
+    
+    def _invalidate_workdir_snapshot(self) -> None:
+        """Drop the cached workdir listing after files change"""
+        self._wd_snapshot = None
+        self._wd_snapshot_generation += 1
+    
+    def _glob_exports(self, glob: str) -> List[Tuple[str, int, float]]:
+        """List (name, size, mtime) for files matching a glob that reaches into subdirectories"""
+        files = []
+        for item in self.workdir.glob(glob):
+            if item.is_file():
+                st = item.stat()
+                files.append((item.name, st.st_size, st.st_mtime))
+        return files
+    
     async def handle_list_exports(self, glob: str = "*", sort_by: str = "mtime", descending: bool = True, limit: int = 200) -> Dict[str, Any]:
         """List files in working directory"""
         ok, error = self.ensure_workdir_set()
@@ -696,29 +1756,35 @@ class TidyBrainServer:
             return {"ok": False, "error": error}
         
         try:
-            files = []
-            for item in self.workdir.glob(glob):
-                if item.is_file():
-                    stat = item.stat()
-                    files.append({
-                        "name": item.name,
-                        "size": stat.st_size,
-                        "mtime": stat.st_mtime,
-                        "extension": item.suffix
-                    })
-            
-            # Sort files
-            if sort_by == "mtime":
-                files.sort(key=lambda x: x["mtime"], reverse=descending)
-            elif sort_by == "size":
-                files.sort(key=lambda x: x["size"], reverse=descending)
-            elif sort_by == "name":
-                files.sort(key=lambda x: x["name"], reverse=descending)
+            if any(sep in glob for sep in ("/", os.sep, "**")):
+                # Patterns reaching into subdirectories still need Path.glob
+                loop = asyncio.get_running_loop()
+                matches = await loop.run_in_executor(None, self._glob_exports, glob)
+            else:
+                pattern = os.fsencode(glob)
+                matches = [
+                    (os.fsdecode(name), size, mtime)
+                    for name, size, mtime in await self._snapshot_workdir()
+                    if fnmatch.fnmatch(name, pattern)
+                ]
+            files = [
+                {
+                    "name": name,
+                    "size": size,
+                    "mtime": mtime,
+                    "extension": os.path.splitext(name)[1]
+                }
+                for name, size, mtime in matches
+            ]
             
-            # Apply limit
-            files = files[:limit]
+            # Sort files, selecting only the top `limit` entries
+            if sort_by in ("mtime", "size", "name"):
+                select = heapq.nlargest if descending else heapq.nsmallest
+                files = select(limit, files, key=operator.itemgetter(sort_by))
+            else:
+                files = files[:limit]
             
-            # Format times
+            # Format times for the returned entries only
             for f in files:
                 f["mtime_str"] = datetime.fromtimestamp(f["mtime"]).isoformat()
             
@@ -765,13 +1831,15 @@ class TidyBrainServer:
             }
         
         try:
-            file_size = file_path.stat().st_size
+            # Read off the event loop so large or slow files do not stall other calls
+            loop = asyncio.get_running_loop()
+            raw, file_size = await loop.run_in_executor(None, _read_head, file_path, max_bytes)
+            truncated = file_size > len(raw)
             
             if as_text:
-                # Read as text with size limit
-                with open(file_path, 'r', encoding=encoding) as f:
-                    content = f.read(max_bytes)
-                truncated = file_size > max_bytes
+                # Decode once; a multi-byte character cut off at the limit is dropped
+                decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+                content = decoder.decode(raw, final=not truncated)
                 
                 return {
                     "ok": True,
@@ -784,16 +1852,12 @@ class TidyBrainServer:
                     }
                 }
             else:
-                # Read as binary and encode to base64
-                with open(file_path, 'rb') as f:
-                    content = f.read(max_bytes)
-                truncated = file_size > max_bytes
-                
+                # Encode straight from the read buffer to base64
                 return {
                     "ok": True,
                     "data": {
                         "name": name,
-                        "content_base64": base64.b64encode(content).decode('ascii'),
+                        "content_base64": base64.b64encode(raw).decode('ascii'),
                         "size": file_size,
                         "truncated": truncated
                     }
@@ -833,29 +1897,19 @@ class TidyBrainServer:
             }
         
         try:
-            rows = []
-            headers = None
-            
-            with open(file_path, 'r', newline='', encoding='utf-8') as f:
-                reader = csv.reader(f, delimiter=delimiter)
-                
-                # Read header
-                try:
-                    headers = next(reader)
-                except StopIteration:
-                    return {
-                        "ok": False,
-                        "error": {
-                            "code": "EMPTY_FILE",
-                            "message": "File is empty"
-                        }
+            # Parse off the event loop; only the previewed rows are ever read
+            loop = asyncio.get_running_loop()
+            headers, rows, truncated = await loop.run_in_executor(
+                None, _read_table_head, file_path, delimiter, max_rows
+            )
+            if headers is None:
+                return {
+                    "ok": False,
+                    "error": {
+                        "code": "EMPTY_FILE",
+                        "message": "File is empty"
                     }
-                
-                # Read data rows
-                for i, row in enumerate(reader):
-                    if i >= max_rows:
-                        break
-                    rows.append(row)
+                }
             
             return {
                 "ok": True,
@@ -865,7 +1919,7 @@ class TidyBrainServer:
                     "rows": rows,
                     "row_count": len(rows),
                     "column_count": len(headers) if headers else 0,
-                    "truncated": len(rows) == max_rows
+                    "truncated": truncated
                 }
             }
         except Exception as e:
@@ -882,28 +1936,17 @@ class TidyBrainServer:
         try:
             optimized, changes = self.optimize_ggplot_code(code)
             
-            # Detect potential issues
+            # Detect potential issues from the markers present in the code
+            found = {match.lastgroup for match in _STYLE_MARKER_RE.finditer(code)}
             issues = []
             suggestions = []
             
-            # Check for theme
-            if 'theme_' not in code:
-                issues.append("No theme specified")
-                suggestions.append("Add theme_minimal(base_size=14) for clean, readable plots")
-            
-            # Check for color palette
-            if 'ggplot(' in code and 'scale_' not in code:
-                issues.append("No explicit color scale")
-                suggestions.append("Add scale_color_brewer(palette='Set2') for categorical or scale_color_viridis() for continuous")
-            
-            # Check for labels
-            if 'labs(' not in code and 'xlab(' not in code and 'ylab(' not in code:
-                issues.append("No axis labels specified")
-                suggestions.append("Add descriptive labels with labs(x='...', y='...', title='...')")
-            
-            # Check for save
-            if 'ggsave(' not in code:
-                suggestions.append("Remember to save with ggsave('filename.png', width=5, height=4, dpi=800)")
+            for trigger, satisfied, issue, suggestion in _STYLE_CHECK_RULES:
+                if not found.issuperset(trigger) or not found.isdisjoint(satisfied):
+                    continue
+                if issue:
+                    issues.append(issue)
+                suggestions.append(suggestion)
             
             return {
                 "ok": True,
@@ -925,6 +1968,14 @@ class TidyBrainServer:
                 }
             }
     
+    def _rdata_ready(self) -> bool:
+        """Whether .RData exists, checked with a single stat so deletions are seen"""
+        try:
+            os.stat(self.workdir / ".RData")
+        except FileNotFoundError:
+            return False
+        return True
+    
     async def handle_inspect_r_objects(self, objects: Optional[List[str]] = None, str_max_level: int = 1, timeout_sec: int = 60) -> Dict[str, Any]:
         """Inspect R objects from saved session"""
         ok, error = self.ensure_workdir_set()
@@ -932,8 +1983,7 @@ class TidyBrainServer:
             return {"ok": False, "error": error}
         
         # Check if .RData exists
-        rdata_path = self.workdir / ".RData"
-        if not rdata_path.exists():
+        if not self._rdata_ready():
             return {
                 "ok": False,
                 "error": {
@@ -946,57 +1996,31 @@ class TidyBrainServer:
         # Build R expression to inspect objects
         if objects:
             # Inspect specific objects
-            inspect_code = f"""
-load('.RData')
-objects_to_inspect <- c({', '.join([f'"{obj}"' for obj in objects])})
-results <- list()
-for(obj_name in objects_to_inspect) {{
-    if(exists(obj_name)) {{
-        obj <- get(obj_name)
-        results[[obj_name]] <- list(
-            class = class(obj),
-            typeof = typeof(obj),
-            length = length(obj),
-            dim = dim(obj),
-            names = names(obj),
-            str = capture.output(str(obj, max.level={str_max_level}))
-        )
-    }} else {{
-        results[[obj_name]] <- "Object not found"
-    }}
-}}
-print(results)
-"""
+            names = ", ".join(_r_string_literal(obj) for obj in objects)
+            inspect_code = R_INSPECT_OBJECTS_TEMPLATE.format(names=names, level=int(str_max_level))
         else:
             # List all objects
-            inspect_code = f"""
-load('.RData')
-obj_list <- ls()
-if(length(obj_list) > 0) {{
-    results <- list()
-    for(obj_name in obj_list) {{
-        obj <- get(obj_name)
-        results[[obj_name]] <- list(
-            class = class(obj),
-            typeof = typeof(obj),
-            length = length(obj),
-            dim = dim(obj)
-        )
-    }}
-    print(results)
-}} else {{
-    print("No objects in workspace")
-}}
-"""
+            inspect_code = R_INSPECT_ALL_TEMPLATE
         
-        result = self.run_r_command(["-e", inspect_code], timeout_sec)
+        result = await self.run_r_command(["-e", inspect_code], timeout_sec)
         
         if result.get("ok"):
+            stdout = result.get("stdout", "")
+            # Structured results when R could emit JSON; the last line holds it
+            try:
+                inspected = json.loads(stdout.rstrip().rsplit("\n", 1)[-1])
+            except ValueError:
+                inspected = None
+            if not isinstance(inspected, dict):
+                inspected = None
             return {
                 "ok": True,
                 "data": {
-                    "stdout": result.get("stdout", ""),
+                    "objects": inspected,
+                    "stdout": stdout,
                     "stderr": result.get("stderr", ""),
+                    "truncated_stdout": result.get("truncated_stdout", False),
+                    "truncated_stderr": result.get("truncated_stderr", False),
                     "objects_requested": objects,
                     "elapsed_seconds": result.get("elapsed_seconds", 0)
                 }
@@ -1008,7 +2032,7 @@ if(length(obj_list) > 0) {{
     
     async def handle_which_r(self) -> Dict[str, Any]:
         """Find R executable"""
-        rscript = shutil.which("Rscript")
+        rscript, r_exe = _resolve_r()
         
         executable = None
         alternatives = []
@@ -1017,7 +2041,6 @@ if(length(obj_list) > 0) {{
             executable = rscript
             alternatives.append(rscript)
         
-        r_exe = shutil.which("R")
         if r_exe:
             if not executable:
                 executable = r_exe
@@ -1048,14 +2071,10 @@ if(length(obj_list) > 0) {{
             return {"ok": False, "error": error}
         
         try:
-            r_files = []
             # Look for both .R and .r extensions
-            for pattern in ["*.R", "*.r"]:
-                for item in self.workdir.glob(pattern):
-                    if item.is_file() and item.name not in r_files:
-                        r_files.append(item.name)
-            
-            r_files.sort()
+            r_files = sorted(
+                os.fsdecode(name) for name, _, _ in await self._snapshot_workdir() if name.endswith((b".R", b".r"))
+            )
             
             return {
                 "ok": True,
@@ -1073,6 +2092,48 @@ if(length(obj_list) > 0) {{
                 }
             }
 
+# Tool definitions advertised by list_tools; static, so built once
+TOOLS = (
+    Tool(name="set_workdir", description="Set the working directory for all R operations", 
+         inputSchema={"type": "object", "properties": {"path": {"type": "string"}, "create": {"type": "boolean", "default": True}}, "required": ["path"]}),
+    Tool(name="get_state", description="Get current TidyBrain state and configuration", 
+         inputSchema={"type": "object", "properties": {}}),
+    Tool(name="create_r_file", description="Create a new R script file", 
+         inputSchema={"type": "object", "properties": {"filename": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}, "scaffold": {"type": "boolean", "default": True}}, "required": ["filename"]}),
+    Tool(name="rename_r_file", description="Rename an R script file", 
+         inputSchema={"type": "object", "properties": {"old_name": {"type": "string"}, "new_name": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}}, "required": ["old_name", "new_name"]}),
+    Tool(name="set_primary_file", description="Set the primary R script file", 
+         inputSchema={"type": "object", "properties": {"filename": {"type": "string"}}, "required": ["filename"]}),
+    Tool(name="append_r_code", description="Append R code to an existing script file", 
+         inputSchema={"type": "object", "properties": {"code": {"type": "string"}, "filename": {"type": "string"}, "ensure_trailing_newline": {"type": "boolean", "default": True}, "count_lines": {"type": "boolean", "default": False}}, "required": ["code"]}),
+    Tool(name="write_r_code", description="Write R code to a script file", 
+         inputSchema={"type": "object", "properties": {"code": {"type": "string"}, "filename": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}, "use_scaffold_header": {"type": "boolean", "default": True}}, "required": ["code"]}),
+    Tool(name="run_r_script", description="Execute an R script file", 
+         inputSchema={"type": "object", "properties": {"filename": {"type": "string"}, "args": {"type": "array", "items": {"type": "string"}}, "timeout_sec": {"type": "integer", "default": 120}, "save_rdata": {"type": "boolean", "default": True}, "no_share": {"type": "boolean", "default": False}, "pure": {"type": "boolean", "default": False}, "cache_bust": {"type": "boolean", "default": False}}}),
+    Tool(name="run_r_expression", description="Execute a single R expression", 
+         inputSchema={"type": "object", "properties": {"expr": {"type": "string"}, "timeout_sec": {"type": "integer", "default": 60}, "no_share": {"type": "boolean", "default": False}, "pure": {"type": "boolean", "default": False}, "cache_bust": {"type": "boolean", "default": False}, "allow_batching": {"type": "boolean", "default": False}}, "required": ["expr"]}),
+    Tool(name="list_exports", description="List files in the working directory", 
+         inputSchema={"type": "object", "properties": {"glob": {"type": "string", "default": "*"}, "sort_by": {"type": "string", "default": "mtime"}, "descending": {"type": "boolean", "default": True}, "limit": {"type": "integer", "default": 200}}}),
+    Tool(name="read_export", description="Read a file from the working directory", 
+         inputSchema={"type": "object", "properties": {"name": {"type": "string"}, "max_bytes": {"type": "integer", "default": 50000}, "as_text": {"type": "boolean", "default": True}, "encoding": {"type": "string", "default": "utf-8"}}, "required": ["name"]}),
+    Tool(name="preview_table", description="Preview a CSV/TSV file as a table", 
+         inputSchema={"type": "object", "properties": {"name": {"type": "string"}, "delimiter": {"type": "string", "default": ","}, "max_rows": {"type": "integer", "default": 50}}, "required": ["name"]}),
+    Tool(name="ggplot_style_check", description="Analyze and optimize ggplot code for publication-quality styling", 
+         inputSchema={"type": "object", "properties": {"code": {"type": "string"}}, "required": ["code"]}),
+    Tool(name="inspect_r_objects", description="Inspect R objects from the last saved session", 
+         inputSchema={"type": "object", "properties": {"objects": {"type": "array", "items": {"type": "string"}}, "str_max_level": {"type": "integer", "default": 1}, "timeout_sec": {"type": "integer", "default": 60}}}),
+    Tool(name="which_r", description="Find R executable in PATH", 
+         inputSchema={"type": "object", "properties": {}}),
+    Tool(name="list_r_files", description="List all R script files in the working directory", 
+         inputSchema={"type": "object", "properties": {}})
+)
+
+@functools.lru_cache(maxsize=64)
+def _unknown_tool_content(name: str) -> TextContent:
+    """Serialized UNKNOWN_TOOL response, reused for repeated bad names"""
+    result = {"ok": False, "error": {"code": "UNKNOWN_TOOL", "message": f"Unknown tool: {name}"}}
+    return TextContent(type="text", text=_dumps(result))
+
 async def main():
     """Main entry point"""
     logger.info("Starting TidyBrain MCP server...")
@@ -1085,86 +2146,43 @@ async def main():
     @server.list_tools()
     async def list_tools():
         logger.debug("Listing tools...")
-        return [
-            Tool(name="set_workdir", description="Set the working directory for all R operations", 
-                 inputSchema={"type": "object", "properties": {"path": {"type": "string"}, "create": {"type": "boolean", "default": True}}, "required": ["path"]}),
-            Tool(name="get_state", description="Get current TidyBrain state and configuration", 
-                 inputSchema={"type": "object", "properties": {}}),
-            Tool(name="create_r_file", description="Create a new R script file", 
-                 inputSchema={"type": "object", "properties": {"filename": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}, "scaffold": {"type": "boolean", "default": True}}, "required": ["filename"]}),
-            Tool(name="rename_r_file", description="Rename an R script file", 
-                 inputSchema={"type": "object", "properties": {"old_name": {"type": "string"}, "new_name": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}}, "required": ["old_name", "new_name"]}),
-            Tool(name="set_primary_file", description="Set the primary R script file", 
-                 inputSchema={"type": "object", "properties": {"filename": {"type": "string"}}, "required": ["filename"]}),
-            Tool(name="append_r_code", description="Append R code to an existing script file", 
-                 inputSchema={"type": "object", "properties": {"code": {"type": "string"}, "filename": {"type": "string"}, "ensure_trailing_newline": {"type": "boolean", "default": True}}, "required": ["code"]}),
-            Tool(name="write_r_code", description="Write R code to a script file", 
-                 inputSchema={"type": "object", "properties": {"code": {"type": "string"}, "filename": {"type": "string"}, "overwrite": {"type": "boolean", "default": False}, "use_scaffold_header": {"type": "boolean", "default": True}}, "required": ["code"]}),
-            Tool(name="run_r_script", description="Execute an R script file", 
-                 inputSchema={"type": "object", "properties": {"filename": {"type": "string"}, "args": {"type": "array", "items": {"type": "string"}}, "timeout_sec": {"type": "integer", "default": 120}, "save_rdata": {"type": "boolean", "default": True}}}),
-            Tool(name="run_r_expression", description="Execute a single R expression", 
-                 inputSchema={"type": "object", "properties": {"expr": {"type": "string"}, "timeout_sec": {"type": "integer", "default": 60}}, "required": ["expr"]}),
-            Tool(name="list_exports", description="List files in the working directory", 
-                 inputSchema={"type": "object", "properties": {"glob": {"type": "string", "default": "*"}, "sort_by": {"type": "string", "default": "mtime"}, "descending": {"type": "boolean", "default": True}, "limit": {"type": "integer", "default": 200}}}),
-            Tool(name="read_export", description="Read a file from the working directory", 
-                 inputSchema={"type": "object", "properties": {"name": {"type": "string"}, "max_bytes": {"type": "integer", "default": 50000}, "as_text": {"type": "boolean", "default": True}, "encoding": {"type": "string", "default": "utf-8"}}, "required": ["name"]}),
-            Tool(name="preview_table", description="Preview a CSV/TSV file as a table", 
-                 inputSchema={"type": "object", "properties": {"name": {"type": "string"}, "delimiter": {"type": "string", "default": ","}, "max_rows": {"type": "integer", "default": 50}}, "required": ["name"]}),
-            Tool(name="ggplot_style_check", description="Analyze and optimize ggplot code for publication-quality styling", 
-                 inputSchema={"type": "object", "properties": {"code": {"type": "string"}}, "required": ["code"]}),
-            Tool(name="inspect_r_objects", description="Inspect R objects from the last saved session", 
-                 inputSchema={"type": "object", "properties": {"objects": {"type": "array", "items": {"type": "string"}}, "str_max_level": {"type": "integer", "default": 1}, "timeout_sec": {"type": "integer", "default": 60}}}),
-            Tool(name="which_r", description="Find R executable in PATH", 
-                 inputSchema={"type": "object", "properties": {}}),
-            Tool(name="list_r_files", description="List all R script files in the working directory", 
-                 inputSchema={"type": "object", "properties": {}})
-        ]
+        return list(TOOLS)
+    
+    # Tool name -> handler, looked up on every call_tool. Tools without
+    # parameters ignore any arguments they are sent.
+    dispatch = {
+        "set_workdir": TidyBrain.handle_set_workdir,
+        "get_state": lambda **_: TidyBrain.handle_get_state(),
+        "create_r_file": TidyBrain.handle_create_r_file,
+        "rename_r_file": TidyBrain.handle_rename_r_file,
+        "set_primary_file": TidyBrain.handle_set_primary_file,
+        "append_r_code": TidyBrain.handle_append_r_code,
+        "write_r_code": TidyBrain.handle_write_r_code,
+        "run_r_script": TidyBrain.handle_run_r_script,
+        "run_r_expression": TidyBrain.handle_run_r_expression,
+        "list_exports": TidyBrain.handle_list_exports,
+        "read_export": TidyBrain.handle_read_export,
+        "preview_table": TidyBrain.handle_preview_table,
+        "ggplot_style_check": TidyBrain.handle_ggplot_style_check,
+        "inspect_r_objects": TidyBrain.handle_inspect_r_objects,
+        "which_r": lambda **_: TidyBrain.handle_which_r(),
+        "list_r_files": lambda **_: TidyBrain.handle_list_r_files(),
+    }
     
     # Register call_tool handler
     @server.call_tool()
     async def call_tool(name: str, arguments: dict):
-        logger.debug(f"Calling tool: {name} with arguments: {arguments}")
+        logger.debug("Calling tool: %s with arguments: %s", name, arguments)
         try:
-            if name == "set_workdir":
-                result = await TidyBrain.handle_set_workdir(**arguments)
-            elif name == "get_state":
-                result = await TidyBrain.handle_get_state()
-            elif name == "create_r_file":
-                result = await TidyBrain.handle_create_r_file(**arguments)
-            elif name == "rename_r_file":
-                result = await TidyBrain.handle_rename_r_file(**arguments)
-            elif name == "set_primary_file":
-                result = await TidyBrain.handle_set_primary_file(**arguments)
-            elif name == "append_r_code":
-                result = await TidyBrain.handle_append_r_code(**arguments)
-            elif name == "write_r_code":
-                result = await TidyBrain.handle_write_r_code(**arguments)
-            elif name == "run_r_script":
-                result = await TidyBrain.handle_run_r_script(**arguments)
-            elif name == "run_r_expression":
-                result = await TidyBrain.handle_run_r_expression(**arguments)
-            elif name == "list_exports":
-                result = await TidyBrain.handle_list_exports(**arguments)
-            elif name == "read_export":
-                result = await TidyBrain.handle_read_export(**arguments)
-            elif name == "preview_table":
-                result = await TidyBrain.handle_preview_table(**arguments)
-            elif name == "ggplot_style_check":
-                result = await TidyBrain.handle_ggplot_style_check(**arguments)
-            elif name == "inspect_r_objects":
-                result = await TidyBrain.handle_inspect_r_objects(**arguments)
-            elif name == "which_r":
-                result = await TidyBrain.handle_which_r()
-            elif name == "list_r_files":
-                result = await TidyBrain.handle_list_r_files()
-            else:
-                result = {"ok": False, "error": {"code": "UNKNOWN_TOOL", "message": f"Unknown tool: {name}"}}
+            handler = dispatch.get(name)
+            if handler is None:
+                return [_unknown_tool_content(name)]
+            result = await handler(**arguments)
             
-            logger.debug(f"Tool {name} result: {result}")
-            return [TextContent(type="text", text=json.dumps(result, indent=2))]
+            logger.debug("Tool %s result: %s", name, result)
+            return [TextContent(type="text", text=_dumps(result))]
         except Exception as e:
-            logger.error(f"Error in tool {name}: {str(e)}")
-            logger.error(traceback.format_exc())
+            logger.error("Error in tool %s: %s", name, e, exc_info=True)
             error_result = {
                 "ok": False,
                 "error": {
@@ -1172,7 +2190,7 @@ async def main():
                     "message": f"Internal error: {str(e)}"
                 }
             }
-            return [TextContent(type="text", text=json.dumps(error_result, indent=2))]
+            return [TextContent(type="text", text=_dumps(error_result))]
     
     # Run server with initialization_options parameter
     try:
@@ -1181,18 +2199,18 @@ async def main():
             initialization_options = server.create_initialization_options()
             await server.run(read_stream, write_stream, initialization_options)
     except Exception as e:
-        logger.error(f"Server error: {e}")
-        logger.error(traceback.format_exc())
+        logger.error("Server error: %s", e, exc_info=True)
         raise
+    finally:
+        TidyBrain.flush_state()
+        await TidyBrain.r_sessions.close_all()
 
 if __name__ == "__main__":
-    import asyncio
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
-        logger.error(traceback.format_exc())
+        logger.error("Fatal error: %s", e, exc_info=True)
         sys.exit(1)
 
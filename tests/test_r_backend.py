@@ -0,0 +1,43 @@
+import asyncio
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "server"))
+
+pytest.importorskip("mcp")
+import main  # noqa: E402
+
+pytestmark = pytest.mark.skipif(shutil.which("R") is None, reason="R is not installed")
+
+
+async def _run_jobs(workdir, codes):
+    backend = await main.RBackend.start(shutil.which("R"), workdir, dict(os.environ))
+    try:
+        return [await backend.run(60, code=code) for code in codes]
+    finally:
+        backend.close()
+        await backend.wait_closed()
+
+
+def test_jobs_do_not_leak_session_state(tmp_path):
+    first, second = asyncio.run(_run_jobs(tmp_path, [
+        'options(digits = 3, tidy.test = TRUE)\n'
+        'library(stats4)\n'
+        'leaked <<- 1\n'
+        'con <- file("scratch.txt", open = "w")\n'
+        'png("plot.png")\n'
+        'plot(1:10)\n',
+        'cat(getOption("digits"), is.null(getOption("tidy.test")), '
+        '"package:stats4" %in% search(), exists("leaked"), '
+        'dev.cur() == 1, any(grepl("scratch", showConnections()[, "description"])), "\\n")\n'
+    ]))
+
+    assert first["ok"], first
+    assert second["ok"], second
+    assert second["stdout"].split() == ["7", "TRUE", "FALSE", "FALSE", "TRUE", "FALSE"]
+    # The device left open by the first job was closed, so its file is complete
+    assert (tmp_path / "plot.png").stat().st_size > 0